@@ -1,7 +1,8 @@
 from transformers import (
-    Trainer, TrainingArguments, AutoTokenizer, AutoModelForCausalLM,
-    BitsAndBytesConfig, DataCollatorForSeq2Seq, EarlyStoppingCallback
+    Trainer, TrainingArguments, AutoConfig, AutoTokenizer, AutoModelForCausalLM,
+    BitsAndBytesConfig, EarlyStoppingCallback, MODEL_FOR_CAUSAL_LM_MAPPING
 )
+from transformers.dynamic_module_utils import get_class_from_dynamic_module
 from peft import (
     get_peft_model, LoraConfig, PeftModel,
     prepare_model_for_kbit_training, set_peft_model_state_dict
@@ -11,14 +12,80 @@ import torch
 import json
 import os
 import sys
-import random
 import warnings
+from collections.abc import Mapping
+from functools import partial
+from types import MappingProxyType
 from lemur_dataset_preparation import DatasetPreparation
 
 os.environ["WANDB_MODE"] = "disabled"
+# tokenization runs in a single process; the Rust tokenizer parallelizes each batch itself
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
 device = torch.device("cuda" if torch.cuda.is_available()  else "cpu")
 
 
+HF_DIRECTORIES: Mapping[int, str] = MappingProxyType({
+    1: "deepseek-ai/DeepSeek-Coder-V2-Lite-Base",
+    2: "deepseek-ai/deepseek-coder-1.3b-base",
+    3: "deepseek-ai/deepseek-coder-1.3b-base",
+    4: "deepseek-ai/DeepSeek-R1-Distill-Qwen-7B",
+    5: "deepseek-ai/deepseek-coder-7b-base-v1.5",
+    6: "deepseek-ai/deepseek-math-7b-base",
+    7: "deepseek-ai/deepseek-coder-7b-instruct-v1.5"
+})
+
+BUCKET_LENGTHS = (256, 512, 1024, 2048)
+
+
+def get_hf_directory(tuned_model_version):
+    """
+    Returns the HuggingFace directory of the base model for a tuned model version
+    """
+    try:
+        return HF_DIRECTORIES[tuned_model_version]
+    except KeyError:
+        raise ValueError(f"Unknown model version: {tuned_model_version}") from None
+
+def quantization_config_4bit():
+    """
+    4-bit NF4 quantization with double quantization and bf16 compute (QLoRA)
+    """
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_use_double_quant=True,
+        bnb_4bit_compute_dtype=torch.bfloat16
+    )
+
+def supports_static_cache(hf_directory):
+    """
+    Checks whether the model class of a HuggingFace directory supports a static KV-cache, without loading its weights
+    """
+    config = AutoConfig.from_pretrained(hf_directory, trust_remote_code=True)
+    auto_map = getattr(config, "auto_map", {})
+    if "AutoModelForCausalLM" in auto_map:
+        model_class = get_class_from_dynamic_module(auto_map["AutoModelForCausalLM"], hf_directory)
+    else:
+        model_class = MODEL_FOR_CAUSAL_LM_MAPPING[type(config)]
+    return getattr(model_class, "_supports_static_cache", False)
+
+def load_model(hf_directory, quantization_config, attn_implementation=None):
+    """
+    Loads a causal LM with the given attention implementation, by default Flash-Attention 2 with a fallback to SDPA
+    for models that do not support it
+    """
+    kwargs = dict(trust_remote_code=True,
+                  device_map="auto",
+                  quantization_config=quantization_config,
+                  torch_dtype=torch.bfloat16)
+    if attn_implementation is not None:
+        return AutoModelForCausalLM.from_pretrained(hf_directory, attn_implementation=attn_implementation, **kwargs)
+    try:
+        return AutoModelForCausalLM.from_pretrained(hf_directory, attn_implementation="flash_attention_2", **kwargs)
+    except (ImportError, ValueError) as e:
+        warnings.warn(f"Flash-Attention 2 is unavailable for {hf_directory}, falling back to SDPA: {e}")
+        return AutoModelForCausalLM.from_pretrained(hf_directory, attn_implementation="sdpa", **kwargs)
+
 def create_prompt(data_point):
     """
     Creates a prompt for the LLM
@@ -43,6 +110,51 @@ def tokenize(prompt, tokenizer):
         return_tensors=None,
     )
 
+def create_prompt_batch(batch):
+    """
+    Creates the prompt column for a batch of data points
+    """
+    return {"text": [create_prompt({"question": question, "answer": answer})
+                     for question, answer in zip(batch["question"], batch["answer"])]}
+
+def bucket_length(length):
+    """
+    Returns the fixed length an example of the given length is padded to
+    """
+    for bucket in BUCKET_LENGTHS:
+        if length <= bucket:
+            return bucket
+    return -(-length // 8) * 8
+
+def tokenize_batch(batch, tokenizer):
+    """
+    Tokenizes the prompt column of a batch with a single tokenizer call and pads every example to its bucket length
+    """
+    tokenized = tokenize(batch["text"], tokenizer)
+    # lengths let the trainer bucket same-length examples without re-measuring them
+    tokenized["length"] = [len(input_ids) for input_ids in tokenized["input_ids"]]
+    tokenized["labels"] = []
+    for input_ids, attention_mask, length in zip(tokenized["input_ids"], tokenized["attention_mask"],
+                                                 tokenized["length"]):
+        padding = bucket_length(length) - length
+        tokenized["labels"].append(input_ids + [-100] * padding)
+        input_ids.extend([tokenizer.pad_token_id] * padding)
+        attention_mask.extend([0] * padding)
+    return tokenized
+
+def collate_bucketed(features, pad_token_id):
+    """
+    Stacks pre-padded examples, padding further only when a batch spans several buckets
+    """
+    max_length = max(len(feature["input_ids"]) for feature in features)
+    pad_values = {"input_ids": pad_token_id, "attention_mask": 0, "labels": -100}
+    return {
+        key: torch.stack([torch.nn.functional.pad(torch.as_tensor(feature[key]),
+                                                  (0, max_length - len(feature[key])), value=value)
+                          for feature in features])
+        for key, value in pad_values.items()
+    }
+
 def main(tuned_model_version, dataset_path):
     """
     The main function for loading data, setting up the model and fine-tuning
@@ -52,42 +164,21 @@ def main(tuned_model_version, dataset_path):
     # log_filename = f"training_logs_{tuned_model_version}.txt"
     # sys.stdout = open(log_filename, "w")
 
-    hf_directories = {
-        1: "deepseek-ai/DeepSeek-Coder-V2-Lite-Base",
-        2: "deepseek-ai/deepseek-coder-1.3b-base",
-        3: "deepseek-ai/deepseek-coder-1.3b-base",
-        4: "deepseek-ai/DeepSeek-R1-Distill-Qwen-7B",
-        5: "deepseek-ai/deepseek-coder-7b-base-v1.5",
-        6: "deepseek-ai/deepseek-math-7b-base",
-        7: "deepseek-ai/deepseek-coder-7b-instruct-v1.5"
-    }
+    # expandable segments reduce fragmentation from variable-length batches; TF32 speeds up the fp32 matmuls
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
 
-    hf_directory = hf_directories.get(tuned_model_version)
-    if hf_directory is None:
-        raise ValueError(f"Unknown model version: {tuned_model_version}")
+    hf_directory = get_hf_directory(tuned_model_version)
     print(f"Using model: {hf_directory}")
 
-    tokenizer = AutoTokenizer.from_pretrained(hf_directory)
+    tokenizer = AutoTokenizer.from_pretrained(hf_directory, use_fast=True)
     tokenizer.add_eos_token = True
     tokenizer.pad_token_id = 0
     tokenizer.padding_side = "right"
 
-    quantization_config_4bit = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_compute_dtype = torch.float16
-    )
-
-    quantization_config_8bit = BitsAndBytesConfig(
-        load_in_8bit=True,
-        bnb_8bit_compute_dtype=torch.float16
-    )
-
-    model = AutoModelForCausalLM.from_pretrained(hf_directory,
-                                                 trust_remote_code=True,
-                                                 device_map="auto",
-                                                 quantization_config=quantization_config_4bit,
-                                                 torch_dtype=torch.float16
-                                                )
+    model = load_model(hf_directory, quantization_config_4bit())
 
     # trying to load mapped datasets
     try:
@@ -95,20 +186,33 @@ def main(tuned_model_version, dataset_path):
             f"Finetuned_models/tuned_model_v{tuned_model_version}/tokenized_train_dataset")
         tokenized_val_dataset = load_from_disk(
             f"Finetuned_models/tuned_model_v{tuned_model_version}/tokenized_val_dataset")
+        # datasets cached by older versions of this script are not bucket-padded and lack labels
+        for tokenized_dataset in (tokenized_train_dataset, tokenized_val_dataset):
+            missing_columns = {"labels", "length"} - set(tokenized_dataset.column_names)
+            if missing_columns:
+                raise ValueError(f"Cached dataset lacks columns {sorted(missing_columns)}")
         print("Datasets loaded successfully.")
     except Exception as e:
         print(f"Dataset loading failed: {e}")
         dataset = load_dataset('json', data_files=dataset_path)
-        shuffled_dataset = dataset['train'].shuffle(seed=42)
 
-        train_dataset = shuffled_dataset.train_test_split(test_size=0.2)["train"]
-        eval_dataset = shuffled_dataset.train_test_split(test_size=0.2)["test"]
+        # a single seeded split keeps train and eval disjoint; it shuffles internally
+        splits = dataset['train'].train_test_split(test_size=0.2, seed=42)
+        train_dataset, eval_dataset = splits["train"], splits["test"]
 
-        num_proc = os.cpu_count() // 2
-        tokenized_train_dataset = train_dataset.map(lambda data_point: tokenize(create_prompt(data_point), tokenizer),
-                                                    num_proc=num_proc)
-        tokenized_val_dataset = eval_dataset.map(lambda data_point: tokenize(create_prompt(data_point), tokenizer),
-                                                 num_proc=num_proc)
+        # prompts are materialized once into an Arrow column, then tokenized from it
+        train_dataset = train_dataset.map(create_prompt_batch, batched=True,
+                                          remove_columns=train_dataset.column_names)
+        eval_dataset = eval_dataset.map(create_prompt_batch, batched=True,
+                                        remove_columns=eval_dataset.column_names)
+
+        # the fast tokenizer parallelizes over the whole batch internally
+        tokenized_train_dataset = train_dataset.map(lambda batch: tokenize_batch(batch, tokenizer),
+                                                    batched=True, batch_size=1000,
+                                                    remove_columns=train_dataset.column_names)
+        tokenized_val_dataset = eval_dataset.map(lambda batch: tokenize_batch(batch, tokenizer),
+                                                 batched=True, batch_size=1000,
+                                                 remove_columns=eval_dataset.column_names)
 
         tokenized_train_dataset.save_to_disk(f"Finetuned_models/tuned_model_v{tuned_model_version}/"
                                              f"tokenized_train_dataset")
@@ -116,20 +220,28 @@ def main(tuned_model_version, dataset_path):
                                            f"tokenized_val_dataset")
         print("Datasets have been processed and saved.")
 
+    tokenized_train_dataset.set_format("torch")
+    tokenized_val_dataset.set_format("torch")
+
     # put model back into training mode
     model.train()
     model = prepare_model_for_kbit_training(model)
+    model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+    model.enable_input_require_grads()
     model.config.use_cache = False
 
     # LoRA config
     peft_config = LoraConfig(
-        r=32,
+        r=16,
         lora_alpha=32,
         target_modules=[
             "q_proj",
             "k_proj",
             "v_proj",
             "o_proj",
+            "gate_proj",
+            "up_proj",
+            "down_proj",
         ],
         lora_dropout=0.05,
         bias="none",
@@ -141,18 +253,26 @@ def main(tuned_model_version, dataset_path):
 
     # Training Arguments
     training_args = TrainingArguments(
-        num_train_epochs=35,
+        num_train_epochs=5,
         warmup_steps=100,
-        optim="adamw_torch",
+        optim="paged_adamw_8bit",
         learning_rate=1e-5,
         logging_steps=10,
         max_grad_norm=1.0,
-        per_device_train_batch_size=1,
-        per_device_eval_batch_size=1,
-        gradient_accumulation_steps=8,
+        per_device_train_batch_size=4,
+        per_device_eval_batch_size=4,
+        gradient_accumulation_steps=2,
         lr_scheduler_type="cosine",
         gradient_checkpointing=True,
-        fp16=True,
+        gradient_checkpointing_kwargs={"use_reentrant": False},
+        group_by_length=True,
+        length_column_name="length",
+        bf16=True,
+        torch_compile=True,
+        dataloader_num_workers=4,
+        dataloader_pin_memory=True,
+        dataloader_persistent_workers=True,
+        dataloader_prefetch_factor=4,
         eval_strategy="epoch",
         save_strategy="epoch",
         output_dir=f"./Finetuned_models/tuned_model_v{tuned_model_version}/output",
@@ -168,9 +288,7 @@ def main(tuned_model_version, dataset_path):
         args=training_args,
         train_dataset=tokenized_train_dataset,
         eval_dataset=tokenized_val_dataset,
-        data_collator=DataCollatorForSeq2Seq(
-        tokenizer, pad_to_multiple_of=8, return_tensors="pt", padding=True
-        ),
+        data_collator=partial(collate_bucketed, pad_token_id=tokenizer.pad_token_id),
         callbacks=[EarlyStoppingCallback(early_stopping_patience=2)]
     )
 
@@ -200,46 +318,14 @@ def main(tuned_model_version, dataset_path):
     # print(f"\nTraining log saved to {log_filename}")
 
 
-def generate_model_responses(tuned_model_version, input_file_path, output_file_path, logs_file_path):
-    hf_directories = {
-        1: "deepseek-ai/DeepSeek-Coder-V2-Lite-Base",
-        2: "deepseek-ai/deepseek-coder-1.3b-base",
-        3: "deepseek-ai/deepseek-coder-1.3b-base",
-        4: "deepseek-ai/DeepSeek-R1-Distill-Qwen-7B",
-        5: "deepseek-ai/deepseek-coder-7b-base-v1.5",
-        6: "deepseek-ai/deepseek-math-7b-base",
-        7: "deepseek-ai/deepseek-coder-7b-instruct-v1.5"
-    }
-
-    hf_directory = hf_directories.get(tuned_model_version)
-    if hf_directory is None:
-        raise ValueError(f"Unknown model version: {tuned_model_version}")
-    print(f"Using model: {hf_directory}")
-
-    quantization_config_8bit = BitsAndBytesConfig(
-        load_in_8bit=True
-    )
-
-    model = AutoModelForCausalLM.from_pretrained(hf_directory,
-                                                 trust_remote_code=True,
-                                                 device_map="auto",
-                                                 quantization_config=quantization_config_8bit)
-    tokenizer = AutoTokenizer.from_pretrained(hf_directory)
-    output_dir = f"./Finetuned_models/tuned_model_v{tuned_model_version}/model"
-    model = PeftModel.from_pretrained(model, output_dir)
-
-    with open(input_file_path, "r") as f:
-        data = json.load(f)
-
-    random.shuffle(data)
-    processed_data = []
-
-    with open(logs_file_path, "w") as output_file:
-        for i, entry in enumerate(data):
-            hyperparameters = entry['prm']
-            prm_names = ", ".join(hyperparameters.keys())
+def create_eval_prompt(entry):
+    """
+    Creates a prompt asking the LLM for the hyperparameters of a model
+    """
+    hyperparameters = entry['prm']
+    prm_names = ", ".join(hyperparameters.keys())
 
-            eval_prompt = f"""
+    return f"""
             ### Input:
             Generate only the values (don't provide any explanation) of the hyperparameters ({prm_names}) of a 
             given model: {entry['metric']} for the task: {entry['task']} on dataset: {entry['dataset']}, 
@@ -250,29 +336,100 @@ def generate_model_responses(tuned_model_version, input_file_path, output_file_p
             ### Response:
             """
 
-            model_input = tokenizer(eval_prompt, return_tensors="pt").to("cuda")
 
-            with torch.no_grad():
-                output = model.generate(**model_input, max_new_tokens=150, pad_token_id=tokenizer.pad_token_id)
-                response_text = tokenizer.decode(output[0], skip_special_tokens=True)
+def generate_model_responses(tuned_model_version, input_file_path, output_file_path, logs_file_path, batch_size=8):
+    hf_directory = get_hf_directory(tuned_model_version)
+    print(f"Using model: {hf_directory}")
 
-            response_text = response_text.split("### Response:")[-1].strip()
+    # a static KV-cache is not supported by remote-code models such as DeepSeek-Coder-V2,
+    # nor by Flash-Attention 2 with left-padded batches, so it is paired with SDPA
+    static_cache = supports_static_cache(hf_directory)
 
-            # Save Logs
-            output_file.write(f"Model #{i + 1}\n")
-            output_file.write(f"Prompt:\n{eval_prompt}\n")
-            output_file.write(f"Response:\n{response_text}\n\n")
+    # the base model is loaded unquantized in bf16 so the adapters merge losslessly
+    model = load_model(hf_directory, None, attn_implementation="sdpa" if static_cache else None)
+    tokenizer = AutoTokenizer.from_pretrained(hf_directory, use_fast=True)
+    output_dir = f"./Finetuned_models/tuned_model_v{tuned_model_version}/model"
+    model = PeftModel.from_pretrained(model, output_dir)
+    model = model.merge_and_unload()
+    model.eval()
 
-            # Save Model's Response to JSON
-            entry['Response'] = response_text
-            processed_data.append(entry)
+    # a dynamic cache grows every decode step, so CUDA graphs only pay off with the static one
+    if static_cache:
+        model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+
+    with open(input_file_path, "r") as f:
+        data = json.load(f)
 
-            print(f"Got {i + 1} responses out of {len(data)}")
+    # length-sorted order is deterministic and keeps padding within each generated batch minimal
+    data.sort(key=lambda entry: len(entry['nn_code']))
+    # responses are appended as they arrive, so a crash mid-run keeps everything generated so far
+    responses_file_path = os.path.splitext(output_file_path)[0] + ".jsonl"
+
+    # left padding keeps every prompt flush against its generated continuation
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+
+    # greedy decoding gives reproducible hyperparameter values
+    max_new_tokens = 150
+    model.generation_config.update(do_sample=False, num_beams=1, temperature=None, top_p=None,
+                                   max_new_tokens=max_new_tokens, pad_token_id=tokenizer.pad_token_id)
+    max_prompt_length = tokenizer.model_max_length - max_new_tokens
+    if static_cache:
+        # together with bucket-padded, constant-size batches (see below) this limits the compiled forward
+        # to one graph per prompt bucket
+        model.generation_config.cache_implementation = "static"
+
+    with open(logs_file_path, "w") as output_file, open(responses_file_path, "w") as responses_file:
+        for start in range(0, len(data), batch_size):
+            batch = data[start:start + batch_size]
+            eval_prompts = [create_eval_prompt(entry) for entry in batch]
+
+            with torch.inference_mode():
+                encoded = tokenizer(eval_prompts)
+                for j, input_ids in enumerate(encoded["input_ids"]):
+                    if len(input_ids) > max_prompt_length:
+                        # truncating from the left keeps the closing "### Response:" cue
+                        warnings.warn(f"Prompt of model #{start + j + 1} has {len(input_ids)} tokens "
+                                      f"and is truncated to the last {max_prompt_length}")
+                        encoded["input_ids"][j] = input_ids[-max_prompt_length:]
+                        encoded["attention_mask"][j] = encoded["attention_mask"][j][-max_prompt_length:]
+                if static_cache:
+                    # the compiled forward needs fixed shapes: the last batch is filled up with copies of its
+                    # final prompt whose responses are discarded, and prompts are padded to a bucket length
+                    for key in ("input_ids", "attention_mask"):
+                        encoded[key] += [encoded[key][-1]] * (batch_size - len(batch))
+                    prompt_length = bucket_length(max(len(input_ids) for input_ids in encoded["input_ids"]))
+                    model_input = tokenizer.pad(encoded, padding="max_length", max_length=prompt_length,
+                                                return_tensors="pt").to("cuda")
+                else:
+                    model_input = tokenizer.pad(encoded, padding=True, return_tensors="pt").to("cuda")
+                output = model.generate(**model_input)
+                response_texts = tokenizer.batch_decode(output[:, model_input.input_ids.shape[1]:],
+                                                        skip_special_tokens=True)
+
+            for i, (entry, eval_prompt, response_text) in enumerate(zip(batch, eval_prompts, response_texts),
+                                                                    start=start):
+                response_text = response_text.strip()
+
+                # Save Logs
+                output_file.write(f"Model #{i + 1}\n")
+                output_file.write(f"Prompt:\n{eval_prompt}\n")
+                output_file.write(f"Response:\n{response_text}\n\n")
+
+                # Save Model's Response to JSONL
+                entry['Response'] = response_text
+                responses_file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+            responses_file.flush()
+            print(f"Got {start + len(batch)} responses out of {len(data)}")
 
     print(f"All responses are saved in {logs_file_path}")
 
+    with open(responses_file_path, "r") as f:
+        processed_data = [json.loads(line) for line in f]
     with open(output_file_path, "w") as f:
-        json.dump(processed_data, f, indent=4)
+        json.dump(processed_data, f, separators=(",", ":"))
 
     print(f"All hyperparameters have been successfully saved to {output_file_path}")
 